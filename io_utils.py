@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+公共读写工具
+================================================
+功能：步骤1-4B 共用的 Excel 读写函数
+
+1. read_xlsx_cached：读取 Excel，优先使用 .feather 缓存
+2. write_feather_cache：为 Excel 写 .feather 缓存
+3. write_excel：使用 xlsxwriter 引擎导出 Excel
+"""
+
+import os
+import logging
+
+import pandas as pd
+
+# 日志由调用脚本的 logging.basicConfig 统一配置
+logger = logging.getLogger(__name__)
+
+
+def read_xlsx_cached(path):
+    """
+    读取 Excel，优先使用同目录下的 .feather 缓存
+    缓存不早于 Excel 时直接读缓存；Excel 被修改后缓存自动失效并重建
+    """
+    cache = path + '.feather'
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return pd.read_feather(cache)
+    df = pd.read_excel(path, engine='calamine')
+    write_feather_cache(df, path)
+    return df
+
+
+def write_feather_cache(df, path):
+    """为 Excel 写 .feather 缓存（先写临时文件再替换；列含混合类型无法写入时跳过）"""
+    cache = path + '.feather'
+    tmp = cache + '.tmp'
+    try:
+        df.reset_index(drop=True).to_feather(tmp)
+        os.replace(tmp, cache)
+    except Exception as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        logger.warning(f"   ⚠️ 跳过缓存写入 {os.path.basename(cache)}: {e}")
+
+
+def write_excel(df, path):
+    """
+    使用 xlsxwriter 引擎导出 Excel（比默认的 openpyxl 写入更快）
+    注意：pandas 按列写入单元格，不能开启 constant_memory（会丢失数据）
+    """
+    with pd.ExcelWriter(path, engine='xlsxwriter',
+                        engine_kwargs={'options': {'strings_to_urls': False}}) as writer:
+        df.to_excel(writer, index=False)
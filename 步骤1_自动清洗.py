@@ -13,14 +13,14 @@
 
 import pandas as pd
 import numpy as np
+from pyarrow import csv as pacsv
 from rapidfuzz import fuzz, process
 from tqdm import tqdm
 import re
 import logging
 from datetime import datetime
-from multiprocessing import Pool, cpu_count
-import warnings
-warnings.filterwarnings('ignore')
+from functools import lru_cache
+from io_utils import read_xlsx_cached, write_excel
 
 # ==========================================
 # 配置日志
@@ -40,10 +40,56 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ==========================================
+# 路径配置（请根据实际情况修改）
+# ==========================================
+FINAL_OUTCOME_PATH = '/Users/lidachuan/Desktop/Patent Data/final_outcome.xlsx'
+PATENT_DB_PATH = '/Users/lidachuan/Desktop/Patent Data/1993-1997/patent_database.csv'
+
+# 专利数据中实际用到的列
+INVENTOR_NAME_COLS = [f'inventor_name{i}' for i in range(1, 11)]
+PATENT_USECOLS = ['assignee', 'inventors', 'application_year'] + INVENTOR_NAME_COLS
+
 # ==========================================
 # 1. 改进的清洗函数
 # ==========================================
 
+# 清洗规则在模块加载时一次性编译，避免每行重复构建正则
+# 1. 常见符号（一次 translate 完成）
+_PUNCT_TABLE = str.maketrans({'&': ' AND ', '-': ' ', "'": None})
+
+# 2. 常见缩写（合并为单个正则，按字典替换）
+_ABBR_MAP = {
+    'INTL': 'INTERNATIONAL',
+    'NATL': 'NATIONAL',
+    'CORP': 'CORPORATION',
+    'INC': 'INCORPORATED',
+    'MFG': 'MANUFACTURING',
+    'TECH': 'TECHNOLOGY',
+    'SYS': 'SYSTEMS',
+}
+_ABBR_RE = re.compile(r'\b(' + '|'.join(_ABBR_MAP) + r')\b')
+
+# 3. 后缀（完整形式优先，其次带点缩写，最后其他形式）
+_SUFFIX_RE = re.compile(
+    r'\b(?:INCORPORATED|CORPORATION|COMPANY|LIMITED|GROUP'
+    r'|CORP\.?|INC\.?|LTD\.?|CO\.?|L\.L\.C\.?|PLC\.?'
+    r'|LLC|S\.A\.|NV|GMBH|SA|AG|KK)\b',
+    flags=re.IGNORECASE
+)
+
+# 4. 标点（保留字母数字空格）
+_PUNCT_RE = re.compile(r'[^A-Z0-9\s]')
+
+# 已是规范形式：仅含大写字母/数字，单空格分隔
+_CANONICAL_RE = re.compile(r'[A-Z0-9]+(?: [A-Z0-9]+)*')
+
+
+def _expand_abbr(match):
+    return _ABBR_MAP[match.group(1)]
+
+
+@lru_cache(maxsize=200_000)
 def clean_company_name(name):
     """
     优化的标准化清洗函数
@@ -51,54 +97,52 @@ def clean_company_name(name):
     - 更精确的后缀处理
     - 保留常见缩写
     - 处理特殊字符的上下文
+    - 结果缓存（专利权人名称大量重复）
     """
     if pd.isna(name) or not isinstance(name, str):
         return ""
     
-    name = str(name).upper().strip()
+    name = name.upper().strip()
+    
+    # 已是规范形式且不含缩写/后缀时，清洗结果即为自身，直接返回
+    if (_CANONICAL_RE.fullmatch(name)
+            and not _ABBR_RE.search(name)
+            and not _SUFFIX_RE.search(name)):
+        return name
     
     # 1. 处理常见符号
-    name = name.replace('&', ' AND ')
-    name = name.replace('-', ' ')
-    name = name.replace("'", '')
+    name = name.translate(_PUNCT_TABLE)
     
     # 2. 扩展常见缩写（提高匹配率）
-    abbreviations = {
-        r'\bINTL\b': 'INTERNATIONAL',
-        r'\bNATL\b': 'NATIONAL',
-        r'\bCORP\b': 'CORPORATION',
-        r'\bINC\b': 'INCORPORATED',
-        r'\bMFG\b': 'MANUFACTURING',
-        r'\bTECH\b': 'TECHNOLOGY',
-        r'\bSYS\b': 'SYSTEMS',
-    }
-    for abbr, full in abbreviations.items():
-        name = re.sub(abbr, full, name)
-    
-    # 3. 分阶段去除后缀（按优先级）
-    # 首先去除完整形式，避免部分匹配问题
-    suffixes_priority = [
-        # 完整形式优先
-        r'\bINCORPORATED\b', r'\bCORPORATION\b', r'\bCOMPANY\b',
-        r'\bLIMITED\b', r'\bGROUP\b',
-        # 带点缩写
-        r'\bCORP\.?\b', r'\bINC\.?\b', r'\bLTD\.?\b', 
-        r'\bCO\.?\b', r'\bL\.L\.C\.?\b', r'\bPLC\.?\b',
-        # 其他形式
-        r'\bLLC\b', r'\bS\.A\.\b', r'\bNV\b', r'\bGMBH\b',
-        r'\bSA\b', r'\bAG\b', r'\bKK\b'
-    ]
+    name = _ABBR_RE.sub(_expand_abbr, name)
     
-    for suffix in suffixes_priority:
-        name = re.sub(suffix, '', name, flags=re.IGNORECASE)
+    # 3. 去除后缀
+    name = _SUFFIX_RE.sub('', name)
     
     # 4. 去除标点（保留字母数字空格）
-    name = re.sub(r'[^A-Z0-9\s]', ' ', name)
+    name = _PUNCT_RE.sub(' ', name)
     
     # 5. 合并多余空格
-    name = re.sub(r'\s+', ' ', name).strip()
-    
-    return name
+    return ' '.join(name.split())
+
+
+def clean_company_name_series(names):
+    """
+    clean_company_name 的整列版本
+    只对唯一值调用（带缓存的）clean_company_name，再用 Series.map(dict) 映射回整列；
+    空值返回空字符串
+    """
+    clean_map = {u: clean_company_name(u) for u in names.dropna().unique()}
+    return names.map(clean_map).fillna('')
+
+
+def sort_name_tokens(names):
+    """
+    词元去重并排序后的规范形式
+    token_set_ratio 只依赖词元集合，对规范形式打分结果不变；
+    词元集合相同的名称可以合并为一个候选
+    """
+    return [' '.join(sorted(set(name.split()))) for name in names]
 
 
 # ==========================================
@@ -108,13 +152,15 @@ def clean_company_name(name):
 def calculate_inventor_count_vectorized(df, inventor_cols):
     """
     按照韩语要求：取 inventors 列和名字列计数的较大值
-    使用向量化操作提升性能
+    使用向量化操作提升性能；结果为 uint16（发明人数不会超出范围，内存仅为 float64 的 1/4）
     """
-    # 1. 从 inventors 列获取数值
-    num_from_column = pd.to_numeric(df['inventors'], errors='coerce').fillna(0)
+    # 1. 从 inventors 列获取数值（异常值截断到 uint16 范围内）
+    # 先转为 NumPy float64：Arrow 类型下非数值文本会变成 NaN（而非 NA），fillna 无法替换
+    num_from_column = pd.to_numeric(df['inventors'], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    num_from_column = np.nan_to_num(num_from_column, nan=0).clip(0, np.iinfo(np.uint16).max).astype(np.uint16)
     
-    # 2. 从名字列计数（向量化操作）
-    num_from_names = df[inventor_cols].notna().sum(axis=1)
+    # 2. 从名字列计数（缺失的名字列由 reindex 一次性补为空值）
+    num_from_names = df.reindex(columns=inventor_cols).notna().sum(axis=1).to_numpy(dtype=np.uint16)
     
     # 3. 取两者中的较大值（符合韩语要求：둘 중 큰 값을 기준으로）
     return np.maximum(num_from_column, num_from_names)
@@ -124,35 +170,122 @@ def calculate_inventor_count_vectorized(df, inventor_cols):
 # 3. 批量模糊匹配函数（支持并行）
 # ==========================================
 
-def fuzzy_match_batch(args):
-    """批量处理模糊匹配（用于并行处理）"""
-    unmatched_chunk, acquiror_list, threshold, tier_name = args
+# 每批查询条数：cdist 为每批分配 (批大小 × 候选数) 的分数矩阵，分批以控制内存
+FUZZY_BATCH_SIZE = 2000
+
+# cdist 线程数（-1 表示使用全部核心；线程共享内存，无需复制候选列表）
+FUZZY_WORKERS = -1
+
+# 清洗后短于此长度的名称（如 '3M'）模糊匹配噪声大，只参与严格匹配
+MIN_FUZZY_NAME_LEN = 3
+
+
+def build_token_index(choices):
+    """倒排索引：词元 → 包含该词元的候选下标数组（用于 blocking）"""
+    postings = {}
+    for i, name in enumerate(choices):
+        for token in set(name.split()):
+            postings.setdefault(token, []).append(i)
+    return {token: np.array(idx, dtype=np.intp) for token, idx in postings.items()}
+
+
+def _best_match_dense(batch, choices, threshold, workers):
+    """整批查询 × 全部候选的相似度矩阵，逐行取最高分"""
+    scores = process.cdist(
+        batch,
+        choices,
+        scorer=fuzz.token_set_ratio,
+        score_cutoff=threshold,
+        dtype=np.float32,
+        workers=workers
+    )
     
-    results = []
-    for _, row in unmatched_chunk.iterrows():
-        assignee = row['assignee']
-        clean = row['clean_name']
-        
-        # 使用 rapidfuzz 的 extractOne，设置 score_cutoff 提前过滤
-        match_result = process.extractOne(
-            clean, 
-            acquiror_list, 
-            scorer=fuzz.token_set_ratio,
-            score_cutoff=threshold
-        )
+    # argmax 取首个最高分，与 extractOne 的并列处理一致
+    best_idx = scores.argmax(axis=1)
+    best_score = scores[np.arange(len(batch)), best_idx]
+    hit = np.flatnonzero(best_score >= threshold)
+    return hit, best_idx[hit], best_score[hit]
+
+
+def _best_match_blocked(batch, choices, threshold, token_index, workers):
+    """只比较至少共享一个词元的 (查询, 候选) 对，逐查询取最高分"""
+    empty = np.array([], dtype=np.intp)
+    pair_query, pair_choice = [], []
+    for i, query in enumerate(batch):
+        postings = [token_index[t] for t in query.split() if t in token_index]
+        candidates = np.unique(np.concatenate(postings)) if postings else empty
+        pair_query.append(np.full(len(candidates), i, dtype=np.intp))
+        pair_choice.append(candidates)
+    
+    pair_query = np.concatenate(pair_query)
+    pair_choice = np.concatenate(pair_choice)
+    if len(pair_query) == 0:
+        return empty, empty, np.array([], dtype=np.float32)
+    
+    scores = process.cpdist(
+        [batch[i] for i in pair_query],
+        [choices[j] for j in pair_choice],
+        scorer=fuzz.token_set_ratio,
+        score_cutoff=threshold,
+        dtype=np.float32,
+        workers=workers
+    )
+    
+    keep = np.flatnonzero(scores >= threshold)
+    pair_query, pair_choice, scores = pair_query[keep], pair_choice[keep], scores[keep]
+    
+    # 每个查询取最高分，并列时取候选下标最小者（与 argmax 一致）
+    order = np.lexsort((pair_choice, -scores, pair_query))
+    hit, first = np.unique(pair_query[order], return_index=True)
+    return hit, pair_choice[order][first], scores[order][first]
+
+
+def fuzzy_match_cdist(queries, choices, threshold, workers=-1, token_index=None):
+    """
+    批量模糊匹配（rapidfuzz.process.cdist）
+    一次计算整批查询与全部候选的相似度矩阵，逐行取最高分；
+    cdist 在 C++ 线程中并行，无需 Pool 的 fork/pickle 开销
+    传入 token_index 时改为 blocking：只比较共享词元的候选对（cpdist）。
+    token_set_ratio 达到 100 必须有共同词元，因此阈值为 100 时结果不变；
+    阈值更低时可能漏掉拼写差异的匹配，不应使用
+    矩阵为 float32 以控制内存，命中项按双精度重算分数（与 extractOne 的输出一致）
+    返回: (命中的查询下标, 对应的候选下标, 相似度)
+    """
+    hit_query_idx, hit_choice_idx = [], []
+    
+    for start in tqdm(range(0, len(queries), FUZZY_BATCH_SIZE), desc="  模糊匹配",
+                      mininterval=0.5, smoothing=0.0):
+        batch = queries[start:start + FUZZY_BATCH_SIZE]
+        if token_index is None:
+            hit, best_idx, _ = _best_match_dense(batch, choices, threshold, workers)
+        else:
+            hit, best_idx, _ = _best_match_blocked(batch, choices, threshold, token_index, workers)
         
-        if match_result:
-            match_name, score, _ = match_result
-            results.append({
-                'Assignee_Original': assignee,
-                'Assignee_Clean': clean,
-                'Matched_Acquiror_Clean': match_name,
-                'Match_Type': f'Fuzzy (≥{threshold})',
-                'Similarity': score,
-                'Tier': tier_name
-            })
+        hit_query_idx.append(hit + start)
+        hit_choice_idx.append(best_idx)
     
-    return results
+    if not hit_query_idx:
+        return np.array([], dtype=np.intp), np.array([], dtype=np.intp), np.array([], dtype=np.float64)
+    
+    hit_query_idx = np.concatenate(hit_query_idx)
+    hit_choice_idx = np.concatenate(hit_choice_idx)
+    hit_scores = np.array(
+        [fuzz.token_set_ratio(queries[i], choices[j]) for i, j in zip(hit_query_idx, hit_choice_idx)],
+        dtype=np.float64
+    )
+    return hit_query_idx, hit_choice_idx, hit_scores
+
+
+def build_match_frame(assignees, cleans, matched, match_type, similarity, tier_name):
+    """按列构建匹配结果表（避免逐行追加字典）"""
+    return pd.DataFrame({
+        'Assignee_Original': assignees,
+        'Assignee_Clean': cleans,
+        'Matched_Acquiror_Clean': matched,
+        'Match_Type': match_type,
+        'Similarity': similarity,
+        'Tier': tier_name
+    })
 
 
 # ==========================================
@@ -212,19 +345,28 @@ def main():
     # ========== 数据加载 ==========
     logger.info("正在加载数据...")
     
-    # 请根据实际情况修改路径
-    df_main = pd.read_excel('/Users/lidachuan/Desktop/Patent Data/final_outcome.xlsx')
-    df_main.drop_duplicates(subset=['acquiror_name'], keep='first', inplace=True)
+    df_main = read_xlsx_cached(FINAL_OUTCOME_PATH)
+    df_main = df_main.loc[~df_main['acquiror_name'].duplicated(keep='first')]
     logger.info(f"✅ 主数据库加载完成: {len(df_main)} 家公司")
     
-    df_patent = pd.read_csv('/Users/lidachuan/Desktop/Patent Data/1993-1997/patent_database.csv')
+    # PyArrow 多线程解析，只读取用到的列（缺失的发明人列稍后补齐）；
+    # 标题、摘要等带引号的单元格可能含换行，分块解析时必须按引号处理
+    header = pd.read_csv(PATENT_DB_PATH, nrows=0).columns
+    df_patent = pacsv.read_csv(
+        PATENT_DB_PATH,
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=[c for c in PATENT_USECOLS if c in header],
+            strings_can_be_null=True
+        )
+    ).to_pandas()
     df_patent.dropna(subset=['assignee'], inplace=True)
     logger.info(f"✅ 专利数据库加载完成: {len(df_patent)} 条记录")
     
     # ========== 名称清洗 ==========
     logger.info("\n正在清洗公司名称...")
-    df_main['clean_name'] = df_main['acquiror_name'].apply(clean_company_name)
-    df_patent['clean_name'] = df_patent['assignee'].apply(clean_company_name)
+    df_main['clean_name'] = clean_company_name_series(df_main['acquiror_name'])
+    df_patent['clean_name'] = clean_company_name_series(df_patent['assignee'])
     
     # 去除清洗后为空的行
     df_patent = df_patent[df_patent['clean_name'] != ""].copy()
@@ -232,39 +374,35 @@ def main():
     
     # ========== 发明人统计 ==========
     logger.info("\n正在计算发明人数量...")
-    inventor_name_cols = [f'inventor_name{i}' for i in range(1, 11)]
-    
-    # 确保列存在
-    for col in inventor_name_cols:
-        if col not in df_patent.columns:
-            df_patent[col] = np.nan
     
     # 使用向量化函数计算发明人数（取最大值，符合韩语要求）
     df_patent['final_inventor_count'] = calculate_inventor_count_vectorized(
         df_patent, 
-        inventor_name_cols
+        INVENTOR_NAME_COLS
     )
     logger.info(f"✅ 发明人统计完成，平均每专利 {df_patent['final_inventor_count'].mean():.2f} 人")
     
     # ========== 生成汇总表 ==========
     logger.info("\n正在生成公司汇总表...")
-    df_summary = df_patent.groupby(['assignee', 'clean_name']).agg({
-        'application_year': 'count',
-        'final_inventor_count': 'sum'
-    }).reset_index()
+    # 分类类型：groupby 按整数编码分组，避免逐行哈希长字符串
+    df_patent['assignee'] = df_patent['assignee'].astype('category')
+    df_patent['clean_name'] = df_patent['clean_name'].astype('category')
     
-    df_summary.rename(columns={
-        'application_year': 'patent_count', 
-        'final_inventor_count': 'inventor_sum'
-    }, inplace=True)
+    df_summary = df_patent.groupby(
+        ['assignee', 'clean_name'], observed=True, sort=False
+    ).agg(
+        patent_count=('application_year', 'count'),
+        inventor_sum=('final_inventor_count', 'sum')
+    ).reset_index()
     
     df_summary = df_summary.sort_values(by='patent_count', ascending=False).reset_index(drop=True)
+    df_summary['clean_name_sorted'] = sort_name_tokens(df_summary['clean_name'])
     logger.info(f"✅ 汇总完成，共 {len(df_summary)} 家专利持有公司")
     
     # 保存中间文件
     if not os.path.exists('temp'):
         os.makedirs('temp')
-    df_summary.to_pickle("temp/temp_summary_optimized.pkl")
+    df_summary.to_parquet("temp/temp_summary_optimized.parquet", index=False)
     
     # ========== 数据分层 ==========
     logger.info("\n正在进行数据分层...")
@@ -282,111 +420,122 @@ def main():
     logger.info(f"   - Tier 3 (其余): {len(df_tier3)} 家公司")
     
     # ========== 准备匹配 ==========
-    acquiror_clean_set = set(df_main['clean_name'].dropna().unique())
-    acquiror_clean_list = list(acquiror_clean_set)
+    # 以下查找结构只构建一次，三个层级共用（只读，可在 cdist 线程间安全共享）
+    acquiror_clean_list = tuple(df_main['clean_name'].dropna().unique())
+    acquiror_clean_index = pd.Index(acquiror_clean_list)
     logger.info(f"\n并购数据库包含 {len(acquiror_clean_list)} 个唯一公司名")
     
-    matches_for_review = []
-    matches_auto = []
+    # 模糊匹配候选：词元集合相同的公司名得分相同，只保留首个
+    acquiror_token_map = {}
+    for clean, tokens in zip(acquiror_clean_list, sort_name_tokens(acquiror_clean_list)):
+        acquiror_token_map.setdefault(tokens, clean)
+    acquiror_fuzzy_choices = tuple(acquiror_token_map)
+    acquiror_fuzzy_names = np.array(list(acquiror_token_map.values()), dtype=object)
+    logger.info(f"模糊匹配候选 {len(acquiror_fuzzy_choices)} 个（按词元集合去重）")
+    acquiror_token_index = build_token_index(acquiror_fuzzy_choices)
+    
+    # 清洗名 → 原始并购方名称（同一清洗名取首次出现）
+    df_acquiror_lookup = df_main.drop_duplicates(subset=['clean_name'], keep='first')
+    clean_to_orig = dict(zip(df_acquiror_lookup['clean_name'], df_acquiror_lookup['acquiror_name']))
     
     # ========== 执行匹配 ==========
     def perform_matching(df_target, tier_name, fuzzy_threshold=None, use_parallel=False):
-        """通用匹配函数"""
-        strict_res = []
-        fuzzy_res = []
-        
+        """
+        通用匹配函数
+        返回: (严格匹配结果, 模糊匹配结果)，均为按列构建的 DataFrame
+        """
         logger.info(f"\n--- 处理 {tier_name} ({len(df_target)} 条记录) ---")
         
         # 1. 严格匹配
         logger.info("  步骤 1/2: 执行严格匹配...")
-        unmatched_list = []
+        is_strict = df_target['clean_name'].isin(acquiror_clean_index)
+        df_strict = df_target[is_strict]
+        df_unmatched = df_target[~is_strict]
         
-        for idx, row in df_target.iterrows():
-            assignee = row['assignee']
-            clean = row['clean_name']
-            
-            if clean in acquiror_clean_set:
-                strict_res.append({
-                    'Assignee_Original': assignee,
-                    'Assignee_Clean': clean,
-                    'Matched_Acquiror_Clean': clean,
-                    'Match_Type': 'Strict',
-                    'Similarity': 100,
-                    'Tier': tier_name
-                })
-            else:
-                unmatched_list.append(row)
+        strict_clean = df_strict['clean_name'].to_numpy(dtype=object)
+        df_strict_res = build_match_frame(
+            df_strict['assignee'].to_numpy(dtype=object),
+            strict_clean,
+            strict_clean,
+            'Strict',
+            100,
+            tier_name
+        )
         
-        logger.info(f"  ✅ 严格匹配: {len(strict_res)} 条命中")
+        logger.info(f"  ✅ 严格匹配: {len(df_strict_res)} 条命中")
         
         # 2. 模糊匹配
-        if fuzzy_threshold is not None and len(unmatched_list) > 0:
-            logger.info(f"  步骤 2/2: 执行模糊匹配 (阈值={fuzzy_threshold})...")
-            
-            df_unmatched = pd.DataFrame(unmatched_list)
-            
-            if use_parallel and len(df_unmatched) > 100:
-                # 并行处理（数据量大时使用）
-                n_cores = min(cpu_count() - 1, 4)  # 最多使用4核
-                chunks = np.array_split(df_unmatched, n_cores)
-                
-                logger.info(f"  使用 {n_cores} 核心并行处理...")
-                with Pool(n_cores) as pool:
-                    args_list = [(chunk, acquiror_clean_list, fuzzy_threshold, tier_name) 
-                                for chunk in chunks]
-                    results = pool.map(fuzzy_match_batch, args_list)
-                
-                # 合并结果
-                for batch_result in results:
-                    fuzzy_res.extend(batch_result)
-            else:
-                # 串行处理（数据量小时更快）
-                for _, row in tqdm(df_unmatched.iterrows(), total=len(df_unmatched), desc="  模糊匹配"):
-                    assignee = row['assignee']
-                    clean = row['clean_name']
-                    
-                    match_result = process.extractOne(
-                        clean, 
-                        acquiror_clean_list, 
-                        scorer=fuzz.token_set_ratio,
-                        score_cutoff=fuzzy_threshold
-                    )
-                    
-                    if match_result:
-                        match_name, score, _ = match_result
-                        fuzzy_res.append({
-                            'Assignee_Original': assignee,
-                            'Assignee_Clean': clean,
-                            'Matched_Acquiror_Clean': match_name,
-                            'Match_Type': f'Fuzzy (≥{fuzzy_threshold})',
-                            'Similarity': score,
-                            'Tier': tier_name
-                        })
-            
-            logger.info(f"  ✅ 模糊匹配: {len(fuzzy_res)} 条命中")
+        if fuzzy_threshold is None or len(df_unmatched) == 0:
+            return df_strict_res, build_match_frame([], [], [], None, [], tier_name)
+        
+        logger.info(f"  步骤 2/2: 执行模糊匹配 (阈值={fuzzy_threshold})...")
+        
+        # 过短名称不参与模糊匹配
+        is_long = df_unmatched['clean_name'].str.len() >= MIN_FUZZY_NAME_LEN
+        if not is_long.all():
+            logger.info(f"  跳过 {(~is_long).sum()} 个过短名称（< {MIN_FUZZY_NAME_LEN} 字符）")
+            df_unmatched = df_unmatched[is_long]
+        
+        # 相同词元集合只计算一次，再按编码映射回每一行
+        codes, unique_queries = pd.factorize(df_unmatched['clean_name_sorted'])
+        query_idx, choice_idx, scores = fuzzy_match_cdist(
+            list(unique_queries),
+            acquiror_fuzzy_choices,
+            fuzzy_threshold,
+            workers=FUZZY_WORKERS if use_parallel else 1,
+            # 阈值 100 时 blocking 不影响结果
+            token_index=acquiror_token_index if fuzzy_threshold >= 100 else None
+        )
+        
+        best_choice = np.full(len(unique_queries), -1, dtype=np.intp)
+        best_score = np.zeros(len(unique_queries), dtype=np.float64)
+        best_choice[query_idx] = choice_idx
+        best_score[query_idx] = scores
+        row_choice = best_choice[codes]
+        hit = np.flatnonzero(row_choice >= 0)
         
-        return strict_res, fuzzy_res
+        df_fuzzy_res = build_match_frame(
+            df_unmatched['assignee'].to_numpy(dtype=object)[hit],
+            df_unmatched['clean_name'].to_numpy(dtype=object)[hit],
+            acquiror_fuzzy_names[row_choice[hit]],
+            f'Fuzzy (≥{fuzzy_threshold})',
+            best_score[codes][hit],
+            tier_name
+        )
+        
+        if len(unique_queries) < len(df_unmatched):
+            logger.info(f"  查询去重: {len(df_unmatched)} → {len(unique_queries)}")
+        
+        logger.info(f"  ✅ 模糊匹配: {len(df_fuzzy_res)} 条命中")
+        
+        return df_strict_res, df_fuzzy_res
     
     # Tier 1: 严格 + 模糊(90) → 全部人工审核
     t1_strict, t1_fuzzy = perform_matching(df_tier1, "Tier 1", fuzzy_threshold=90, use_parallel=True)
-    matches_for_review.extend(t1_strict)
-    matches_for_review.extend(t1_fuzzy)
     
     # Tier 2: 严格(自动) + 模糊100(人工)
     t2_strict, t2_fuzzy = perform_matching(df_tier2, "Tier 2", fuzzy_threshold=100, use_parallel=True)
-    matches_auto.extend(t2_strict)
-    matches_for_review.extend(t2_fuzzy)
     
-    # Tier 3: 仅严格(自动)
-    t3_strict, t3_fuzzy = perform_matching(df_tier3, "Tier 3", fuzzy_threshold=None)
-    matches_auto.extend(t3_strict)
+    # Tier 3: 仅严格(自动)，最大的一层，直接与并购库按清洗名做哈希连接
+    logger.info(f"\n--- 处理 Tier 3 ({len(df_tier3)} 条记录) ---")
+    df_t3 = df_tier3[['assignee', 'clean_name']].merge(
+        df_acquiror_lookup[['clean_name']], on='clean_name', how='inner'
+    )
+    t3_clean = df_t3['clean_name'].to_numpy(dtype=object)
+    t3_strict = build_match_frame(
+        df_t3['assignee'].to_numpy(dtype=object), t3_clean, t3_clean, 'Strict', 100, "Tier 3"
+    )
+    logger.info(f"  ✅ 严格匹配: {len(t3_strict)} 条命中")
+    
+    df_review = pd.concat([t1_strict, t1_fuzzy, t2_fuzzy], ignore_index=True)
+    df_auto = pd.concat([t2_strict, t3_strict], ignore_index=True)
     
     # ========== 质量检查 ==========
     logger.info("\n" + "=" * 60)
     logger.info("执行质量控制检查...")
     logger.info("=" * 60)
     
-    df_all_matches = pd.DataFrame(matches_for_review + matches_auto)
+    df_all_matches = pd.concat([df_review, df_auto], ignore_index=True)
     issues, stats = validate_matches(df_all_matches)
     
     for issue in issues:
@@ -395,29 +544,21 @@ def main():
     # ========== 导出结果 ==========
     logger.info("\n正在导出结果文件...")
     
-    def get_orig_acquiror(clean_val):
-        try:
-            return df_main[df_main['clean_name'] == clean_val]['acquiror_name'].iloc[0]
-        except:
-            return ""
-    
     # 1. 人工审核文件
-    if matches_for_review:
-        df_review = pd.DataFrame(matches_for_review)
-        df_review['Original_Acquiror_Name'] = df_review['Matched_Acquiror_Clean'].apply(get_orig_acquiror)
+    if not df_review.empty:
+        df_review['Original_Acquiror_Name'] = df_review['Matched_Acquiror_Clean'].map(clean_to_orig).fillna("")
         df_review.sort_values(by=['Match_Type', 'Similarity'], ascending=[True, True], inplace=True)
         
         output_review = "Step1_Manual_Review.xlsx"
-        df_review.to_excel(output_review, index=False)
+        write_excel(df_review, output_review)
         logger.info(f"✅ 人工审核文件: {output_review} ({len(df_review)} 条)")
     
-    # 2. 自动接受文件
-    if matches_auto:
-        df_auto = pd.DataFrame(matches_auto)
-        df_auto['Original_Acquiror_Name'] = df_auto['Matched_Acquiror_Clean'].apply(get_orig_acquiror)
+    # 2. 自动接受文件（仅供步骤2读取，使用 Parquet）
+    if not df_auto.empty:
+        df_auto['Original_Acquiror_Name'] = df_auto['Matched_Acquiror_Clean'].map(clean_to_orig).fillna("")
         
-        output_auto = "Step1_Auto_Results.xlsx"
-        df_auto.to_excel(output_auto, index=False)
+        output_auto = "Step1_Auto_Results.parquet"
+        df_auto.to_parquet(output_auto, index=False)
         logger.info(f"✅ 自动接受文件: {output_auto} ({len(df_auto)} 条)")
     
     # ========== 统计摘要 ==========
@@ -431,8 +572,8 @@ def main():
     logger.info(f"处理速度: {len(df_patent) / duration:.0f} 条/秒")
     logger.info(f"\n匹配结果:")
     logger.info(f"  - 总匹配数: {len(df_all_matches)}")
-    logger.info(f"  - 需人工审核: {len(matches_for_review)}")
-    logger.info(f"  - 自动接受: {len(matches_auto)}")
+    logger.info(f"  - 需人工审核: {len(df_review)}")
+    logger.info(f"  - 自动接受: {len(df_auto)}")
     logger.info(f"  - 匹配率: {len(df_all_matches) / len(df_summary) * 100:.2f}%")
     
     if 'match_types' in stats:
@@ -14,8 +14,10 @@
 import pandas as pd
 import os
 import pickle
+import sys
 import logging
 from datetime import datetime
+from io_utils import write_excel
 
 # ==========================================
 # 配置日志
@@ -37,11 +39,11 @@ logger = logging.getLogger(__name__)
 FILES_TO_PROCESS = [
     # --- 1993-1997年文件 ---
     'Step1_Manual_Review.xlsx',      # 人工审核后的文件（删除错误匹配）
-    'Step1_Auto_Results.xlsx',       # 自动匹配结果
+    'Step1_Auto_Results.parquet',    # 自动匹配结果
     
-    # --- 如果有其他年份，添加在此 ---
+    # --- 如果有其他年份，添加在此（支持 .xlsx 与 .parquet） ---
     # '1998_2000_Manual_Review.xlsx',
-    # '1998_2000_Auto_Results.xlsx',
+    # '1998_2000_Auto_Results.parquet',
 
 ]
 
@@ -53,18 +55,26 @@ OUTPUT_EXCEL_FILE = 'Master_Company_Dictionary_VIEW.xlsx' # 用于人工查看
 # 2. 主处理函数
 # ==========================================
 
+def read_match_file(file_path):
+    """按扩展名读取匹配结果文件（Parquet 或 Excel）"""
+    if file_path.endswith('.parquet'):
+        return pd.read_parquet(file_path)
+    return pd.read_excel(file_path, engine='calamine')
+
+
 def build_master_dictionary(files_list):
     """
     构建超级字典
+    各文件的有效行先合并为一张表，再用向量化的去重/比较
+    一次性完成新增、重复、冲突的判定（保留首次出现的映射）
     返回: master_dict, statistics
     """
     logger.info("=" * 60)
     logger.info("开始构建超级字典（Master Company Dictionary）")
     logger.info("=" * 60)
     
-    master_dict = {}  # 结构: { 'Assignee_Original': 'Original_Acquiror_Name' }
-    source_stats = []
-    conflicts = []  # 记录冲突
+    frames = []        # 各文件的有效映射行
+    loaded_files = []  # 成功读取的文件（保持处理顺序）
     
     for file_path in files_list:
         if not os.path.exists(file_path):
@@ -74,7 +84,7 @@ def build_master_dictionary(files_list):
         logger.info(f"\n正在处理: {file_path}")
         
         try:
-            df = pd.read_excel(file_path)
+            df = read_match_file(file_path)
             
             # 检查必要的列
             required_cols = ['Assignee_Original', 'Original_Acquiror_Name']
@@ -83,58 +93,70 @@ def build_master_dictionary(files_list):
                 continue
             
             # 过滤无效行
-            df_valid = df.dropna(subset=required_cols)
-            df_valid = df_valid[
-                (df_valid['Assignee_Original'].astype(str).str.strip() != "") &
-                (df_valid['Original_Acquiror_Name'].astype(str).str.strip() != "")
-            ]
+            df_valid = pd.DataFrame({
+                'Assignee': df['Assignee_Original'],
+                'Acquiror': df['Original_Acquiror_Name']
+            }).dropna()
+            df_valid = df_valid.astype(str).apply(lambda col: col.str.strip())
+            df_valid = df_valid[(df_valid['Assignee'] != "") & (df_valid['Acquiror'] != "")]
+            df_valid['Source_Index'] = len(loaded_files)
             
             logger.info(f"   有效行数: {len(df_valid)}")
             
-            # 统计信息
-            count_new = 0
-            count_duplicate = 0
-            count_conflict = 0
-            
-            for idx, row in df_valid.iterrows():
-                assignee_raw = str(row['Assignee_Original']).strip()
-                acquiror_std = str(row['Original_Acquiror_Name']).strip()
-                
-                if assignee_raw not in master_dict:
-                    # 新映射
-                    master_dict[assignee_raw] = acquiror_std
-                    count_new += 1
-                else:
-                    # 已存在的映射
-                    existing = master_dict[assignee_raw]
-                    if existing == acquiror_std:
-                        # 重复但一致
-                        count_duplicate += 1
-                    else:
-                        # 冲突！
-                        count_conflict += 1
-                        conflicts.append({
-                            'Assignee': assignee_raw,
-                            'Existing_Acquiror': existing,
-                            'New_Acquiror': acquiror_std,
-                            'Source_File': file_path
-                        })
-                        # 策略：保留第一次出现的映射，记录冲突
-                        logger.warning(f"   ⚠️  冲突: '{assignee_raw}' 已映射为 '{existing}'，新值 '{acquiror_std}' 被忽略")
-            
-            logger.info(f"   ✅ 处理完成: 新增 {count_new}，重复 {count_duplicate}，冲突 {count_conflict}")
-            
-            source_stats.append({
-                'File': os.path.basename(file_path),
-                'Valid_Rows': len(df_valid),
-                'New_Mappings': count_new,
-                'Duplicates': count_duplicate,
-                'Conflicts': count_conflict
-            })
+            frames.append(df_valid)
+            loaded_files.append(file_path)
             
         except Exception as e:
             logger.error(f"   ❌ 读取失败: {e}")
     
+    if not frames:
+        return {}, [], []
+    
+    df_all = pd.concat(frames, ignore_index=True)
+    
+    # 首次出现的映射即为最终映射
+    df_first = df_all.drop_duplicates(subset=['Assignee'], keep='first')
+    master_dict = dict(zip(df_first['Assignee'], df_first['Acquiror']))  # 结构: { 'Assignee_Original': 'Original_Acquiror_Name' }
+    
+    # 判定每一行：新增 / 重复但一致 / 冲突
+    is_new = ~df_all['Assignee'].duplicated(keep='first')
+    existing = df_all['Assignee'].map(master_dict)
+    is_duplicate = ~is_new & (df_all['Acquiror'] == existing)
+    is_conflict = ~is_new & (df_all['Acquiror'] != existing)
+    
+    df_conflicts = pd.DataFrame({
+        'Assignee': df_all.loc[is_conflict, 'Assignee'],
+        'Existing_Acquiror': existing[is_conflict],
+        'New_Acquiror': df_all.loc[is_conflict, 'Acquiror'],
+        'Source_File': df_all.loc[is_conflict, 'Source_Index'].map(dict(enumerate(loaded_files)))
+    })
+    # 冲突只汇总计数，明细统一导出到冲突报告（避免逐条日志）
+    if not df_conflicts.empty:
+        logger.warning(f"\n⚠️  检测到 {len(df_conflicts)} 条冲突（保留首次出现的映射），明细见冲突报告")
+    conflicts = df_conflicts.to_dict('records')
+    
+    # 按文件统计
+    counts = pd.DataFrame({
+        'Source_Index': df_all['Source_Index'],
+        'New_Mappings': is_new,
+        'Duplicates': is_duplicate,
+        'Conflicts': is_conflict
+    }).groupby('Source_Index').sum()
+    
+    source_stats = []
+    for i, file_path in enumerate(loaded_files):
+        count_new, count_duplicate, count_conflict = (
+            counts.loc[i].tolist() if i in counts.index else (0, 0, 0)
+        )
+        source_stats.append({
+            'File': os.path.basename(file_path),
+            'Valid_Rows': int((df_all['Source_Index'] == i).sum()),
+            'New_Mappings': int(count_new),
+            'Duplicates': int(count_duplicate),
+            'Conflicts': int(count_conflict)
+        })
+        logger.info(f"   ✅ {os.path.basename(file_path)}: 新增 {count_new}，重复 {count_duplicate}，冲突 {count_conflict}")
+    
     return master_dict, source_stats, conflicts
 
 
@@ -149,8 +171,10 @@ def save_dictionary(master_dict, source_stats, conflicts):
         return False
     
     # 1. 保存为 Pickle（用于后续代码加载）
+    # 收购方名称大量重复：驻留为同一对象后 pickle 只写一次（文件更小、加载更快，加载后共享内存）
+    interned_dict = {k: sys.intern(v) for k, v in master_dict.items()}
     with open(OUTPUT_DICT_FILE, 'wb') as f:
-        pickle.dump(master_dict, f)
+        pickle.dump(interned_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
     logger.info(f"✅ Pickle文件已保存: {OUTPUT_DICT_FILE}")
     
     # 2. 保存为 Excel（用于人工查看）
@@ -159,21 +183,21 @@ def save_dictionary(master_dict, source_stats, conflicts):
         columns=['Assignee_Original_Name', 'Mapped_Acquiror_Name']
     )
     df_out = df_out.sort_values('Mapped_Acquiror_Name').reset_index(drop=True)
-    df_out.to_excel(OUTPUT_EXCEL_FILE, index=False)
+    write_excel(df_out, OUTPUT_EXCEL_FILE)
     logger.info(f"✅ Excel文件已保存: {OUTPUT_EXCEL_FILE}")
     
     # 3. 保存统计信息
     if source_stats:
         df_stats = pd.DataFrame(source_stats)
         stats_file = 'Dictionary_Build_Statistics.xlsx'
-        df_stats.to_excel(stats_file, index=False)
+        write_excel(df_stats, stats_file)
         logger.info(f"✅ 统计信息已保存: {stats_file}")
     
     # 4. 如果有冲突，保存冲突报告
     if conflicts:
         df_conflicts = pd.DataFrame(conflicts)
         conflict_file = 'Dictionary_Conflicts.xlsx'
-        df_conflicts.to_excel(conflict_file, index=False)
+        write_excel(df_conflicts, conflict_file)
         logger.warning(f"⚠️  冲突报告已保存: {conflict_file} ({len(conflicts)} 条冲突)")
     
     return True
@@ -14,10 +14,14 @@
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pacsv
 import pickle
+import gc
 import logging
 from datetime import datetime
 from tqdm import tqdm
+from io_utils import read_xlsx_cached, write_feather_cache, write_excel
 
 # ==========================================
 # 配置日志
@@ -52,6 +56,13 @@ PATENT_DB_PATH = '/Users/lidachuan/Desktop/Patent Data/1993-1997/patent_database
 # 输出文件路径
 OUTPUT_PATH = '/Users/lidachuan/Desktop/Patent Data/final_outcome_1993_1997_COMPLETE.xlsx'
 
+# 专利数据中实际用到的列
+INVENTOR_NAME_COLS = [f'inventor_name{i}' for i in range(1, 11)]
+PATENT_USECOLS = ['assignee', 'inventors', 'application_year'] + INVENTOR_NAME_COLS
+
+# 分块读取专利数据时每块的字节数（约数十万行；内存峰值由块大小而非文件大小决定）
+PATENT_BLOCK_SIZE = 64 << 20
+
 # ==========================================
 # 2. 发明人统计函数（符合韩语要求）
 # ==========================================
@@ -59,13 +70,15 @@ OUTPUT_PATH = '/Users/lidachuan/Desktop/Patent Data/final_outcome_1993_1997_COMP
 def calculate_inventor_count_vectorized(df, inventor_cols):
     """
     按照韩语要求：取 inventors 列和名字列计数的较大值
-    使用向量化操作提升性能
+    使用向量化操作提升性能；结果为 uint16（发明人数不会超出范围，内存仅为 float64 的 1/4）
     """
-    # 1. 从 inventors 列获取数值
-    num_from_column = pd.to_numeric(df['inventors'], errors='coerce').fillna(0)
+    # 1. 从 inventors 列获取数值（异常值截断到 uint16 范围内）
+    # 先转为 NumPy float64：Arrow 类型下非数值文本会变成 NaN（而非 NA），fillna 无法替换
+    num_from_column = pd.to_numeric(df['inventors'], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    num_from_column = np.nan_to_num(num_from_column, nan=0).clip(0, np.iinfo(np.uint16).max).astype(np.uint16)
     
-    # 2. 从名字列计数（向量化操作）
-    num_from_names = df[inventor_cols].notna().sum(axis=1)
+    # 2. 从名字列计数（缺失的名字列由 reindex 一次性补为空值）
+    num_from_names = df.reindex(columns=inventor_cols).notna().to_numpy().sum(axis=1, dtype=np.uint16)
     
     # 3. 取两者中的较大值（符合韩语要求）
     return np.maximum(num_from_column, num_from_names)
@@ -76,7 +89,7 @@ def calculate_inventor_count_vectorized(df, inventor_cols):
 
 def load_master_dictionary():
     """加载超级字典"""
-    logger.info("步骤 1/6: 加载超级字典...")
+    logger.info("步骤 1/5: 加载超级字典...")
     try:
         with open(DICT_PATH, 'rb') as f:
             master_dict = pickle.load(f)
@@ -90,10 +103,10 @@ def load_master_dictionary():
 
 def load_main_database():
     """加载主数据库模板"""
-    logger.info("\n步骤 2/6: 加载主数据库模板...")
+    logger.info("\n步骤 2/5: 加载主数据库模板...")
     try:
-        df_main = pd.read_excel(FINAL_OUTCOME_PATH)
-        df_main.drop_duplicates(subset=['acquiror_name'], keep='first', inplace=True)
+        df_main = read_xlsx_cached(FINAL_OUTCOME_PATH)
+        df_main = df_main.loc[~df_main['acquiror_name'].duplicated(keep='first')]
         logger.info(f"   ✅ 模板加载成功，共 {len(df_main):,} 家公司")
         return df_main
     except FileNotFoundError:
@@ -101,114 +114,175 @@ def load_main_database():
         raise
 
 
-def load_patent_database():
-    """加载专利数据库"""
-    logger.info("\n步骤 3/6: 加载专利数据库...")
-    try:
-        df_patent = pd.read_csv(PATENT_DB_PATH, low_memory=False)
-        original_count = len(df_patent)
-        
-        # 去除assignee为空的行
-        df_patent.dropna(subset=['assignee'], inplace=True)
-        logger.info(f"   ✅ 专利数据加载完成: {len(df_patent):,} 条有效记录（原始 {original_count:,}）")
-        return df_patent
-    except FileNotFoundError:
-        logger.error(f"   ❌ 错误：找不到专利数据文件 {PATENT_DB_PATH}")
-        raise
+def iter_patent_chunks(usecols, typed):
+    """
+    用 PyArrow 流式分块读取专利数据（列投影 + 指定列类型），逐块返回 DataFrame
+    typed=True 时年份按 int32、发明人数按 float64 解析；
+    typed=False 时两列按文本读取后再转换（兼容 1994.0 或文本等写法）
+    """
+    # 显式指定所有列的类型：流式读取只按首块推断类型，后续块类型不一致会报错
+    column_types = {c: pa.string() for c in usecols}
+    if typed:
+        column_types.update({'application_year': pa.int32(), 'inventors': pa.float64()})
+    
+    reader = pacsv.open_csv(
+        PATENT_DB_PATH,
+        read_options=pacsv.ReadOptions(use_threads=True, block_size=PATENT_BLOCK_SIZE),
+        # 标题、摘要等带引号的单元格可能含换行，分块时必须按引号处理
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=usecols,
+            column_types=column_types,
+            strings_can_be_null=True
+        )
+    )
+    for batch in reader:
+        df_chunk = batch.to_pandas()
+        if not typed:
+            df_chunk['application_year'] = pd.to_numeric(df_chunk['application_year'], errors='coerce')
+        yield df_chunk
 
 
 def process_patent_data(df_patent, master_dict):
-    """处理专利数据：应用字典映射和统计发明人"""
-    logger.info("\n步骤 4/6: 处理专利数据...")
-    
-    # 应用映射
-    logger.info("   应用字典映射...")
-    df_patent['assignee_stripped'] = df_patent['assignee'].astype(str).str.strip()
-    df_patent['Matched_Acquiror'] = df_patent['assignee_stripped'].map(master_dict)
-    
-    # 统计匹配率
-    matched_count = df_patent['Matched_Acquiror'].notna().sum()
-    match_rate = matched_count / len(df_patent) * 100
-    logger.info(f"   ✅ 映射完成: {matched_count:,} / {len(df_patent):,} ({match_rate:.2f}%)")
-    
-    # 只保留匹配成功的
-    df_matched = df_patent.dropna(subset=['Matched_Acquiror']).copy()
-    
-    # 清洗年份
-    logger.info("   清洗年份数据...")
-    df_matched['application_year'] = pd.to_numeric(df_matched['application_year'], errors='coerce')
-    df_matched = df_matched.dropna(subset=['application_year'])
+    """处理一块专利数据：应用字典映射和统计发明人，返回匹配成功的行"""
+    # 只对唯一的专利权人名称去空格并查字典，再按编码映射回每一行（唯一值远少于行数）
+    codes, uniques = pd.factorize(df_patent['assignee'])
+    matched_uniques = pd.Series(uniques).astype(str).str.strip().map(master_dict).to_numpy()
+    df_patent['Matched_Acquiror'] = matched_uniques[codes]
+    
+    # 只保留匹配成功且年份有效的行
+    df_matched = df_patent.dropna(subset=['Matched_Acquiror', 'application_year']).copy()
     df_matched['application_year'] = df_matched['application_year'].astype(int)
     
     # 统计发明人数量（按韩语要求）
-    logger.info("   计算发明人数量...")
-    inventor_name_cols = [f'inventor_name{i}' for i in range(1, 11)]
-    
-    # 确保列存在
-    for col in inventor_name_cols:
-        if col not in df_matched.columns:
-            df_matched[col] = np.nan
-    
     df_matched['final_inventor_count'] = calculate_inventor_count_vectorized(
         df_matched, 
-        inventor_name_cols
+        INVENTOR_NAME_COLS
     )
     
-    logger.info(f"   ✅ 处理完成，平均每专利 {df_matched['final_inventor_count'].mean():.2f} 位发明人")
-    
     return df_matched
 
 
-def aggregate_data(df_matched):
-    """聚合数据：按公司和年份统计"""
-    logger.info("\n步骤 5/6: 聚合数据...")
+def aggregate_chunk(df_matched):
+    """单块的部分聚合：(公司, 年份) 的专利数/发明人数，以及去重后的 (公司, 别名) 对"""
+    df_counts = df_matched.groupby(['Matched_Acquiror', 'application_year']).agg(
+        patent=('assignee', 'count'),  # 专利数量
+        patent_inventor=('final_inventor_count', 'sum')  # 发明人总数
+    )
+    df_alias = df_matched[['Matched_Acquiror', 'assignee']].drop_duplicates()
+    return df_counts, df_alias
+
+
+def stream_patent_database(master_dict, usecols, typed):
+    """
+    逐块读取、映射并部分聚合专利数据，不保留整表
+    内存峰值取决于块大小与（公司 × 年份）的组合数，而非文件大小
+    返回: (各块的部分统计, 各块的别名对, 计数信息)
+    """
+    partial_counts, partial_aliases = [], []
+    totals = {'rows': 0, 'valid': 0, 'matched': 0, 'kept': 0, 'inventors': 0}
+    
+    for df_chunk in tqdm(iter_patent_chunks(usecols, typed), desc="   读取进度",
+                         unit="块", mininterval=0.5, smoothing=0.0):
+        totals['rows'] += len(df_chunk)
+        
+        # 去除assignee为空的行
+        df_chunk = df_chunk.dropna(subset=['assignee']).copy()
+        totals['valid'] += len(df_chunk)
+        
+        df_matched = process_patent_data(df_chunk, master_dict)
+        totals['matched'] += int(df_chunk['Matched_Acquiror'].notna().sum())
+        totals['kept'] += len(df_matched)
+        totals['inventors'] += int(df_matched['final_inventor_count'].sum())
+        
+        df_counts, df_alias = aggregate_chunk(df_matched)
+        partial_counts.append(df_counts)
+        partial_aliases.append(df_alias)
+        
+        # 读取下一块之前释放本块，内存中最多只保留一块明细
+        del df_chunk, df_matched
+    
+    # 文件只有表头时没有任何块：返回一组空的部分结果（列与正常块一致），聚合时按无匹配处理
+    if not partial_counts:
+        df_counts, df_alias = aggregate_chunk(pd.DataFrame(
+            columns=['Matched_Acquiror', 'application_year', 'assignee', 'final_inventor_count']
+        ))
+        partial_counts.append(df_counts)
+        partial_aliases.append(df_alias)
+    
+    return partial_counts, partial_aliases, totals
+
+
+def load_patent_database(master_dict):
+    """分块加载并处理专利数据库"""
+    logger.info("\n步骤 3/5: 分块加载并处理专利数据库...")
+    try:
+        # 只读取用到的列（缺失的发明人列在计数时按空值处理）
+        header = pd.read_csv(PATENT_DB_PATH, nrows=0).columns
+        usecols = [c for c in PATENT_USECOLS if c in header]
+        try:
+            result = stream_patent_database(master_dict, usecols, typed=True)
+        except pa.ArrowInvalid as e:
+            # 只处理年份/发明人数列的类型转换失败（其余列均按文本读取）；其他解析错误直接抛出
+            if 'conversion error' not in str(e):
+                raise
+            # 年份/发明人数列含非数值内容，整体重读并按原方式转换
+            logger.warning(f"   application_year/inventors 含非数值内容（{e}），改为按文本读取后再转换")
+            result = stream_patent_database(master_dict, usecols, typed=False)
+    except FileNotFoundError:
+        logger.error(f"   ❌ 错误：找不到专利数据文件 {PATENT_DB_PATH}")
+        raise
+    
+    partial_counts, partial_aliases, totals = result
+    logger.info(f"   ✅ 专利数据加载完成: {totals['valid']:,} 条有效记录（原始 {totals['rows']:,}）")
+    
+    match_rate = totals['matched'] / totals['valid'] * 100 if totals['valid'] else 0
+    logger.info(f"   ✅ 映射完成: {totals['matched']:,} / {totals['valid']:,} ({match_rate:.2f}%)")
+    
+    avg_inventors = totals['inventors'] / totals['kept'] if totals['kept'] else 0
+    logger.info(f"   ✅ 处理完成，平均每专利 {avg_inventors:.2f} 位发明人")
     
-    # 按公司和年份分组
+    return partial_counts, partial_aliases, totals['valid']
+
+
+def aggregate_data(partial_counts, partial_aliases):
+    """聚合数据：合并各块的部分统计，按公司和年份展开"""
+    logger.info("\n步骤 4/5: 聚合数据...")
+    
+    # 合并各块的 (公司, 年份) 部分统计，再 unstack 为宽表（年份为列）
     logger.info("   按公司和年份分组统计...")
-    df_grouped = df_matched.groupby(['Matched_Acquiror', 'application_year']).agg({
-        'assignee': 'count',  # 专利数量
-        'final_inventor_count': 'sum'  # 发明人总数
-    }).reset_index()
-    
-    # 透视表：专利数量
-    logger.info("   生成专利数量透视表...")
-    pivot_patent = df_grouped.pivot(
-        index='Matched_Acquiror', 
-        columns='application_year', 
-        values='assignee'
-    )
-    pivot_patent.columns = [f'patent_{int(col)}' for col in pivot_patent.columns]
-    
-    # 透视表：发明人数量
-    logger.info("   生成发明人数量透视表...")
-    pivot_inventor = df_grouped.pivot(
-        index='Matched_Acquiror', 
-        columns='application_year', 
-        values='final_inventor_count'
+    df_counts = pd.concat(partial_counts).groupby(level=['Matched_Acquiror', 'application_year']).sum()
+    
+    # 没有专利匹配到字典时统计为空：主表原样输出，不增加统计/别名列
+    if df_counts.empty:
+        logger.warning("   ⚠️ 没有专利匹配到字典中的公司，统计结果为空")
+        df_empty = pd.DataFrame({'acquiror_name': pd.Series(dtype=object)})
+        return df_empty, df_empty.copy()
+    
+    df_stats = (
+        df_counts
+        .unstack('application_year', fill_value=0)
+        .astype(np.int32)  # 计数用 int32 足够
     )
-    pivot_inventor.columns = [f'patent_inventor_{int(col)}' for col in pivot_inventor.columns]
     
-    # 合并透视表
-    df_stats = pd.concat([pivot_patent, pivot_inventor], axis=1).reset_index()
+    # 展平列名：patent_{年份}, patent_inventor_{年份}
+    patent_cols = [f'patent_{int(year)}' for year in df_stats['patent'].columns]
+    df_stats.columns = [f'{stat}_{int(year)}' for stat, year in df_stats.columns]
+    df_stats = df_stats.reset_index()
     df_stats.rename(columns={'Matched_Acquiror': 'acquiror_name'}, inplace=True)
     
     logger.info(f"   ✅ 聚合完成，涵盖 {len(df_stats)} 家公司")
-    logger.info(f"   年份范围: {pivot_patent.columns.tolist()[:3]}...{pivot_patent.columns.tolist()[-3:]}")
+    logger.info(f"   年份范围: {patent_cols[:3]}...{patent_cols[-3:]}")
     
     # 收集公司别名
     logger.info("   收集公司别名...")
-    df_names = df_matched.groupby('Matched_Acquiror')['assignee'].apply(
-        lambda x: list(set(x))
-    ).reset_index()
-    
-    # 展开别名列表
-    max_len = df_names['assignee'].apply(len).max() if not df_names.empty else 0
-    name_cols = ['patent_name'] + [f'patent_name_{i}' for i in range(1, max_len)]
-    names_expanded = pd.DataFrame(df_names['assignee'].tolist(), index=df_names.index)
-    names_expanded = names_expanded.iloc[:, :len(name_cols)]
-    names_expanded.columns = name_cols[:names_expanded.shape[1]]
-    
-    df_names = pd.concat([df_names[['Matched_Acquiror']], names_expanded], axis=1)
+    # 各块别名对再去重（保留首次出现），按出现顺序编号后透视为 patent_name, patent_name_1, ... 列
+    df_alias = pd.concat(partial_aliases, ignore_index=True).drop_duplicates()
+    df_alias['alias_rank'] = df_alias.groupby('Matched_Acquiror').cumcount()
+    df_names = df_alias.pivot(index='Matched_Acquiror', columns='alias_rank', values='assignee')
+    df_names.columns = ['patent_name' if i == 0 else f'patent_name_{i}' for i in df_names.columns]
+    
+    df_names = df_names.reset_index()
     df_names.rename(columns={'Matched_Acquiror': 'acquiror_name'}, inplace=True)
     
     return df_stats, df_names
@@ -216,7 +290,7 @@ def aggregate_data(df_matched):
 
 def merge_to_final_outcome(df_main, df_stats, df_names):
     """合并到最终文件"""
-    logger.info("\n步骤 6/6: 合并到最终文件...")
+    logger.info("\n步骤 5/5: 合并到最终文件...")
     
     # 清理可能存在的旧列
     logger.info("   清理旧的统计列...")
@@ -226,6 +300,17 @@ def merge_to_final_outcome(df_main, df_stats, df_names):
         df_main = df_main.drop(columns=cols_to_remove, errors='ignore')
         logger.info(f"   移除了 {len(cols_to_remove)} 个旧列")
     
+    # 三张表的合并键转为同一 Categorical 类型，merge 直接比较整数编码而非逐个哈希字符串
+    key_dtype = df_main['acquiror_name'].dtype
+    key_cats = pd.CategoricalDtype(
+        pd.concat([df_main['acquiror_name'], df_stats['acquiror_name'], df_names['acquiror_name']])
+        .dropna()
+        .unique()
+    )
+    df_main = df_main.astype({'acquiror_name': key_cats})
+    df_stats = df_stats.astype({'acquiror_name': key_cats})
+    df_names = df_names.astype({'acquiror_name': key_cats})
+    
     # 合并统计数据
     logger.info("   合并统计数据...")
     df_final = pd.merge(df_main, df_stats, on='acquiror_name', how='left')
@@ -234,11 +319,14 @@ def merge_to_final_outcome(df_main, df_stats, df_names):
     logger.info("   合并别名数据...")
     df_final = pd.merge(df_final, df_names, on='acquiror_name', how='left')
     
+    # 合并键还原为原类型（输出文件与后续步骤读取的仍是普通字符串列）
+    df_final['acquiror_name'] = df_final['acquiror_name'].astype(key_dtype)
+    
     # 填充 NaN 为 0（仅数值列）
     stat_cols = [c for c in df_final.columns 
                 if (c.startswith('patent_') or c.startswith('patent_inventor_')) 
                 and 'name' not in c]
-    df_final[stat_cols] = df_final[stat_cols].fillna(0).astype(int)
+    df_final[stat_cols] = df_final[stat_cols].fillna(0).astype(np.int32)
     
     logger.info(f"   ✅ 合并完成，最终文件共 {len(df_final)} 行")
     
@@ -252,7 +340,9 @@ def merge_to_final_outcome(df_main, df_stats, df_names):
 def save_output(df_final):
     """保存输出文件"""
     logger.info("\n保存结果...")
-    df_final.to_excel(OUTPUT_PATH, index=False)
+    write_excel(df_final, OUTPUT_PATH)
+    # 同步写 .feather 缓存，步骤4A/4B 直接读取，无需重新解析 Excel
+    write_feather_cache(df_final, OUTPUT_PATH)
     logger.info(f"✅ 结果已保存至: {OUTPUT_PATH}")
 
 
@@ -274,18 +364,22 @@ def main():
         # 步骤2: 加载主数据库
         df_main = load_main_database()
         
-        # 步骤3: 加载专利数据
-        df_patent = load_patent_database()
-        
-        # 步骤4: 处理专利数据
-        df_matched = process_patent_data(df_patent, master_dict)
+        # 步骤3: 分块加载并处理专利数据（逐块部分聚合）
+        partial_counts, partial_aliases, patent_count = load_patent_database(master_dict)
+        del master_dict  # 字典只在映射阶段使用
         
-        # 步骤5: 聚合数据
-        df_stats, df_names = aggregate_data(df_matched)
+        # 步骤4: 聚合数据
+        df_stats, df_names = aggregate_data(partial_counts, partial_aliases)
+        del partial_counts, partial_aliases
+        gc.collect()
         
-        # 步骤6: 合并到最终文件
+        # 步骤5: 合并到最终文件
         df_final = merge_to_final_outcome(df_main, df_stats, df_names)
         
+        # 写 Excel 前释放中间表（写入阶段内存占用最高）
+        del df_main, df_stats, df_names
+        gc.collect()
+        
         # 保存结果
         save_output(df_final)
         
@@ -296,7 +390,7 @@ def main():
         logger.info("处理完成！")
         logger.info("=" * 60)
         logger.info(f"⏱  总耗时: {duration:.2f} 秒")
-        logger.info(f"📊 处理速度: {len(df_patent) / duration:.0f} 条/秒")
+        logger.info(f"📊 处理速度: {patent_count / duration:.0f} 条/秒")
         logger.info(f"\n✅ 下一步: 运行步骤4（Compustat匹配）")
         
         return True
@@ -11,11 +11,15 @@ Compustat匹配 - 步骤4A：生成验证文件（优化版）
 """
 
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pacsv
 import re
 from rapidfuzz import process, fuzz
 from tqdm import tqdm
 import logging
 from datetime import datetime
+from io_utils import read_xlsx_cached, write_excel
 
 # ==========================================
 # 配置日志
@@ -42,63 +46,148 @@ PATH_MA = "/Users/lidachuan/Desktop/Patent Data/final_outcome_1993_1997_COMPLETE
 PATH_COMPUSTAT = "/Users/lidachuan/Desktop/Patent Data/compustat_19802025.csv"
 OUTPUT_VERIFICATION = "/Users/lidachuan/Desktop/Patent Data/company_match_verification.xlsx"
 
+# Compustat 清洗结果缓存（唯一的 conm → clean_conm 表，Compustat 文件或清洗规则更新后自动重建）
+COMPUSTAT_CACHE_PATH = PATH_COMPUSTAT + '.cleaned.parquet'
+
 FUZZY_THRESHOLD = 90  # 模糊匹配阈值
 
+# 每批查询条数：cdist 为每批分配 (批大小 × Compustat 候选数) 的分数矩阵，分批以控制内存
+FUZZY_BATCH_SIZE = 1000
+
+# cdist 线程数（-1 表示使用全部核心）
+FUZZY_WORKERS = -1
+
 # ==========================================
 # 2. 清洗函数（与步骤1保持一致）
 # ==========================================
 
+# 清洗规则在模块加载时一次性编译，避免每行重复构建正则
+# 1. 常见符号（一次 translate 完成）
+_PUNCT_TABLE = str.maketrans({'&': ' AND ', '-': ' ', "'": None})
+
+# 2. 常见缩写（合并为单个正则，按字典替换）
+_ABBR_MAP = {
+    'INTL': 'INTERNATIONAL',
+    'NATL': 'NATIONAL',
+    'CORP': 'CORPORATION',
+    'INC': 'INCORPORATED',
+    'MFG': 'MANUFACTURING',
+    'TECH': 'TECHNOLOGY',
+    'SYS': 'SYSTEMS',
+}
+_ABBR_RE = re.compile(r'\b(' + '|'.join(_ABBR_MAP) + r')\b')
+
+# 3. 后缀（完整形式优先，其次带点缩写，最后其他形式）
+_SUFFIX_RE = re.compile(
+    r'\b(?:INCORPORATED|CORPORATION|COMPANY|LIMITED|GROUP'
+    r'|CORP\.?|INC\.?|LTD\.?|CO\.?|L\.L\.C\.?|PLC\.?'
+    r'|LLC|S\.A\.|NV|GMBH|SA|AG|KK)\b',
+    flags=re.IGNORECASE
+)
+
+# 4. 标点（保留字母数字空格）
+_PUNCT_RE = re.compile(r'[^A-Z0-9\s]')
+
+
+def _expand_abbr(match):
+    return _ABBR_MAP[match.group(1)]
+
+
 def clean_company_name(name):
     """优化的标准化清洗函数"""
     if pd.isna(name) or not isinstance(name, str):
         return ""
     
-    name = str(name).upper().strip()
+    name = name.upper().strip()
     
     # 1. 处理常见符号
-    name = name.replace('&', ' AND ')
-    name = name.replace('-', ' ')
-    name = name.replace("'", '')
+    name = name.translate(_PUNCT_TABLE)
     
     # 2. 扩展常见缩写
-    abbreviations = {
-        r'\bINTL\b': 'INTERNATIONAL',
-        r'\bNATL\b': 'NATIONAL',
-        r'\bCORP\b': 'CORPORATION',
-        r'\bINC\b': 'INCORPORATED',
-        r'\bMFG\b': 'MANUFACTURING',
-        r'\bTECH\b': 'TECHNOLOGY',
-        r'\bSYS\b': 'SYSTEMS',
-    }
-    for abbr, full in abbreviations.items():
-        name = re.sub(abbr, full, name)
+    name = _ABBR_RE.sub(_expand_abbr, name)
     
     # 3. 去除后缀
-    suffixes_priority = [
-        r'\bINCORPORATED\b', r'\bCORPORATION\b', r'\bCOMPANY\b',
-        r'\bLIMITED\b', r'\bGROUP\b',
-        r'\bCORP\.?\b', r'\bINC\.?\b', r'\bLTD\.?\b', 
-        r'\bCO\.?\b', r'\bL\.L\.C\.?\b', r'\bPLC\.?\b',
-        r'\bLLC\b', r'\bS\.A\\.b', r'\bNV\b', r'\bGMBH\b',
-        r'\bSA\b', r'\bAG\b', r'\bKK\b'
-    ]
-    
-    for suffix in suffixes_priority:
-        name = re.sub(suffix, '', name, flags=re.IGNORECASE)
+    name = _SUFFIX_RE.sub('', name)
     
     # 4. 去除标点
-    name = re.sub(r'[^A-Z0-9\s]', ' ', name)
+    name = _PUNCT_RE.sub(' ', name)
     
     # 5. 合并空格
-    name = re.sub(r'\s+', ' ', name).strip()
-    
-    return name
+    return ' '.join(name.split())
+
+
+def clean_company_name_series(names):
+    """
+    clean_company_name 的整列版本
+    只对唯一值调用 clean_company_name，再用 Series.map(dict) 映射回整列；
+    空值返回空字符串
+    """
+    clean_map = {u: clean_company_name(u) for u in names.dropna().unique()}
+    return names.map(clean_map).fillna('')
 
 
 # ==========================================
 # 3. 主处理函数
 # ==========================================
 
+def fuzzy_match_cdist(queries, choices, threshold):
+    """
+    批量模糊匹配（rapidfuzz.process.cdist）
+    分批计算查询 × 全部候选的相似度矩阵（C++ 多线程），逐行取最高分
+    返回: (命中的查询下标, 对应的候选下标)
+    """
+    hit_query_idx, hit_choice_idx = [], []
+    
+    if len(choices) > 0:
+        for start in tqdm(range(0, len(queries), FUZZY_BATCH_SIZE), desc="   匹配进度",
+                          mininterval=0.5, smoothing=0.0):
+            batch = queries[start:start + FUZZY_BATCH_SIZE]
+            scores = process.cdist(
+                batch,
+                choices,
+                scorer=fuzz.token_set_ratio,
+                score_cutoff=threshold,
+                dtype=np.float32,
+                workers=FUZZY_WORKERS
+            )
+            
+            # argmax 取首个最高分，与 extractOne 的并列处理一致
+            best_idx = scores.argmax(axis=1)
+            hit = np.flatnonzero(scores[np.arange(len(batch)), best_idx] >= threshold)
+            hit_query_idx.append(hit + start)
+            hit_choice_idx.append(best_idx[hit])
+    
+    if not hit_query_idx:
+        return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+    
+    return np.concatenate(hit_query_idx), np.concatenate(hit_choice_idx)
+
+
+def load_compustat_names_cached():
+    """
+    读取缓存的 Compustat 唯一公司名表 (conm, clean_conm)
+    缓存不早于 Compustat 文件和本脚本（清洗规则）时有效，否则返回 None
+    """
+    if not os.path.exists(COMPUSTAT_CACHE_PATH):
+        return None
+    cache_mtime = os.path.getmtime(COMPUSTAT_CACHE_PATH)
+    if cache_mtime < os.path.getmtime(PATH_COMPUSTAT) or cache_mtime < os.path.getmtime(__file__):
+        return None
+    return pd.read_parquet(COMPUSTAT_CACHE_PATH)
+
+
+def save_compustat_names_cache(compustat_unique):
+    """写入 Compustat 清洗缓存（先写临时文件再替换，失败时跳过）"""
+    tmp = COMPUSTAT_CACHE_PATH + '.tmp'
+    try:
+        compustat_unique.to_parquet(tmp, index=False)
+        os.replace(tmp, COMPUSTAT_CACHE_PATH)
+    except Exception as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        logger.warning(f"   ⚠️ 跳过缓存写入 {os.path.basename(COMPUSTAT_CACHE_PATH)}: {e}")
+
+
 def main():
     start_time = datetime.now()
     
@@ -112,7 +201,7 @@ def main():
     # 读取 M&A 数据
     logger.info("   加载 M&A 数据...")
     try:
-        df_ma = pd.read_excel(PATH_MA)
+        df_ma = read_xlsx_cached(PATH_MA)
         logger.info(f"   ✅ M&A 数据加载成功: {len(df_ma):,} 行")
     except Exception as e:
         logger.error(f"   ❌ 读取失败: {e}")
@@ -122,33 +211,52 @@ def main():
     df_ma_target = df_ma[df_ma['patent_name'].notna()].copy()
     logger.info(f"   过滤 patent_name 非空: {len(df_ma_target):,} 行待匹配")
     
-    # 读取 Compustat 数据（只读取 conm 列以节省内存）
-    logger.info("   加载 Compustat 数据（仅公司名列）...")
-    try:
-        # 策略：大文件只读取需要的列（conm）
-        df_comp = pd.read_csv(PATH_COMPUSTAT, usecols=['conm'], low_memory=False)
-        logger.info(f"   ✅ Compustat 数据加载成功: {len(df_comp):,} 行")
-    except ValueError:
-        # 如果列名不匹配，尝试全量读取（但可能很慢）
-        logger.warning("   列名 'conm' 未找到，尝试全量读取...")
-        df_comp = pd.read_csv(PATH_COMPUSTAT, low_memory=False)
-        logger.info(f"   ✅ Compustat 数据加载成功（全量）: {len(df_comp):,} 行")
-    except Exception as e:
-        logger.error(f"   ❌ 读取失败: {e}")
-        return False
+    # 读取 Compustat 数据：命中清洗缓存时跳过读取与清洗
+    compustat_unique = load_compustat_names_cached()
+    if compustat_unique is not None:
+        logger.info(f"   ✅ 使用 Compustat 清洗缓存: {len(compustat_unique):,} 个唯一公司名")
+    else:
+        # 只读取 conm 列以节省内存
+        logger.info("   加载 Compustat 数据（仅公司名列）...")
+        try:
+            # 策略：大文件只读取需要的列（conm）
+            # PyArrow 多线程分块解析，列投影只解码 conm
+            df_comp = pacsv.read_csv(
+                PATH_COMPUSTAT,
+                read_options=pacsv.ReadOptions(use_threads=True, block_size=1 << 22),
+                parse_options=pacsv.ParseOptions(newlines_in_values=True),  # 带引号的单元格可能含换行
+                convert_options=pacsv.ConvertOptions(
+                    include_columns=['conm'],
+                    column_types={'conm': pa.string()},
+                    strings_can_be_null=True
+                )
+            ).to_pandas()
+            logger.info(f"   ✅ Compustat 数据加载成功: {len(df_comp):,} 行")
+        except KeyError:
+            # 如果列名不匹配，尝试全量读取（但可能很慢）
+            logger.warning("   列名 'conm' 未找到，尝试全量读取...")
+            df_comp = pd.read_csv(PATH_COMPUSTAT, low_memory=False)
+            logger.info(f"   ✅ Compustat 数据加载成功（全量）: {len(df_comp):,} 行")
+        except pa.ArrowInvalid as e:
+            logger.error(f"   ❌ Compustat CSV 解析失败: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"   ❌ 读取失败: {e}")
+            return False
     
     # ========== 步骤2: 清洗数据 ==========
     logger.info("\n步骤 2/4: 清洗公司名称...")
     
     # 清洗 M&A 的 acquiror_name
-    df_ma_target['clean_acquiror'] = df_ma_target['acquiror_name'].apply(clean_company_name)
+    df_ma_target['clean_acquiror'] = clean_company_name_series(df_ma_target['acquiror_name'])
     
-    # 清洗 Compustat 的 conm
-    df_comp['clean_conm'] = df_comp['conm'].apply(clean_company_name)
+    # 清洗 Compustat 的 conm（未命中缓存时），结果写入缓存供下次运行使用
+    if compustat_unique is None:
+        df_comp['clean_conm'] = clean_company_name_series(df_comp['conm'])
+        compustat_unique = df_comp[df_comp['clean_conm'] != ""][['conm', 'clean_conm']].drop_duplicates(subset=['clean_conm'])
+        save_compustat_names_cache(compustat_unique)
     
     # 创建 Compustat 查找集合
-    compustat_unique = df_comp[df_comp['clean_conm'] != ""][['conm', 'clean_conm']].drop_duplicates(subset=['clean_conm'])
-    compustat_clean_set = set(compustat_unique['clean_conm'])
     compustat_clean_list = list(compustat_unique['clean_conm'])
     
     logger.info(f"   ✅ Compustat 唯一公司名: {len(compustat_clean_list):,}")
@@ -156,57 +264,48 @@ def main():
     # ========== 步骤3: 执行匹配 ==========
     logger.info("\n步骤 3/4: 执行匹配...")
     
-    strict_res = []
     fuzzy_res = []
-    unmatched_rows = []
     
-    # 3.1 严格匹配
+    # 3.1 严格匹配（向量化：清洗后名称直接在 Compustat 名称中哈希查找）
     logger.info("   阶段 3.1: 精确匹配...")
-    for idx, row in df_ma_target.iterrows():
-        acquiror_orig = row['acquiror_name']
-        acquiror_clean = row['clean_acquiror']
-        
-        if not acquiror_clean:
-            continue
-        
-        if acquiror_clean in compustat_clean_set:
-            strict_res.append({
-                'Acquiror_Original': acquiror_orig,
-                'Acquiror_Clean': acquiror_clean,
-                'Matched_Compustat_Clean': acquiror_clean,
-                'Match_Type': 'Strict',
-                'Score': 100
-            })
-        else:
-            unmatched_rows.append(row)
+    df_candidates = df_ma_target[df_ma_target['clean_acquiror'] != ""]
+    is_strict = df_candidates['clean_acquiror'].isin(compustat_unique['clean_conm'])
     
-    logger.info(f"   ✅ 精确匹配: {len(strict_res)} 条")
-    logger.info(f"   待模糊匹配: {len(unmatched_rows)} 条")
+    df_strict = pd.DataFrame({
+        'Acquiror_Original': df_candidates.loc[is_strict, 'acquiror_name'],
+        'Acquiror_Clean': df_candidates.loc[is_strict, 'clean_acquiror'],
+        'Matched_Compustat_Clean': df_candidates.loc[is_strict, 'clean_acquiror'],
+        'Match_Type': 'Strict',
+        'Score': 100
+    })
+    df_unmatched = df_candidates[~is_strict]
+    
+    logger.info(f"   ✅ 精确匹配: {len(df_strict)} 条")
+    logger.info(f"   待模糊匹配: {len(df_unmatched)} 条")
     
     # 3.2 模糊匹配
-    if len(unmatched_rows) > 0:
+    if len(df_unmatched) > 0:
         logger.info(f"   阶段 3.2: 模糊匹配 (阈值 {FUZZY_THRESHOLD})...")
         
-        for row in tqdm(unmatched_rows, desc="   匹配进度"):
-            acquiror_orig = row['acquiror_name']
-            acquiror_clean = row['clean_acquiror']
-            
-            match_result = process.extractOne(
-                acquiror_clean, 
-                compustat_clean_list, 
-                scorer=fuzz.token_set_ratio,
-                score_cutoff=FUZZY_THRESHOLD
-            )
-            
-            if match_result:
-                match_name, score, _ = match_result
-                fuzzy_res.append({
-                    'Acquiror_Original': acquiror_orig,
-                    'Acquiror_Clean': acquiror_clean,
-                    'Matched_Compustat_Clean': match_name,
-                    'Match_Type': 'Fuzzy',
-                    'Score': score
-                })
+        queries = df_unmatched['clean_acquiror'].tolist()
+        acquiror_origs = df_unmatched['acquiror_name'].tolist()
+        hit_query_idx, hit_choice_idx = fuzzy_match_cdist(
+            queries, compustat_clean_list, FUZZY_THRESHOLD
+        )
+        
+        for qi, ci in zip(hit_query_idx, hit_choice_idx):
+            acquiror_clean = queries[qi]
+            match_name = compustat_clean_list[ci]
+            # 矩阵为 float32，命中项按双精度重算分数（与 extractOne 的输出一致）；
+            # score_cutoff 在转换前生效，命中项必然达到阈值
+            score = fuzz.token_set_ratio(acquiror_clean, match_name)
+            fuzzy_res.append({
+                'Acquiror_Original': acquiror_origs[qi],
+                'Acquiror_Clean': acquiror_clean,
+                'Matched_Compustat_Clean': match_name,
+                'Match_Type': 'Fuzzy',
+                'Score': score
+            })
         
         logger.info(f"   ✅ 模糊匹配: {len(fuzzy_res)} 条")
     
@@ -214,7 +313,6 @@ def main():
     logger.info("\n步骤 4/4: 生成人工验证文件...")
     
     # 合并结果
-    df_strict = pd.DataFrame(strict_res)
     df_fuzzy = pd.DataFrame(fuzzy_res)
     df_all_matches = pd.concat([df_strict, df_fuzzy], ignore_index=True)
     
@@ -242,7 +340,7 @@ def main():
     df_verify.sort_values(by=['Match_Type', 'Score'], ascending=[True, True], inplace=True)
     
     # 导出
-    df_verify.to_excel(OUTPUT_VERIFICATION, index=False)
+    write_excel(df_verify, OUTPUT_VERIFICATION)
     
     # ========== 完成摘要 ==========
     duration = (datetime.now() - start_time).total_seconds()
@@ -252,7 +350,7 @@ def main():
     logger.info("=" * 60)
     logger.info(f"⏱  总耗时: {duration:.2f} 秒")
     logger.info(f"📊 匹配结果:")
-    logger.info(f"   - 精确匹配: {len(strict_res)}")
+    logger.info(f"   - 精确匹配: {len(df_strict)}")
     logger.info(f"   - 模糊匹配: {len(fuzzy_res)}")
     logger.info(f"   - 总计: {len(df_verify):,} 对")
     logger.info(f"\n📁 输出文件:")
@@ -11,8 +11,11 @@ Compustat匹配 - 步骤4B：应用审核结果（优化版）
 """
 
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pacsv
 import logging
 from datetime import datetime
+from io_utils import read_xlsx_cached, write_feather_cache, write_excel
 
 # ==========================================
 # 配置日志
@@ -57,7 +60,7 @@ def main():
     # 读取主表
     logger.info("   加载主表...")
     try:
-        df_main = pd.read_excel(PATH_MAIN)
+        df_main = read_xlsx_cached(PATH_MAIN)
         logger.info(f"   ✅ 主表加载完成: {len(df_main):,} 行")
     except Exception as e:
         logger.error(f"   ❌ 读取失败: {e}")
@@ -66,10 +69,9 @@ def main():
     # 读取人工验证表（已审核）
     logger.info("   加载人工验证表...")
     try:
-        df_verify = pd.read_excel(
-            PATH_VERIFIED, 
-            usecols=['Acquiror_Original', 'Matched_Compustat_Original']
-        )
+        df_verify = read_xlsx_cached(PATH_VERIFIED)[
+            ['Acquiror_Original', 'Matched_Compustat_Original']
+        ]
         # 去重
         df_verify = df_verify.drop_duplicates(subset=['Acquiror_Original'])
         logger.info(f"   ✅ 验证表加载完成: {len(df_verify):,} 个有效匹配对")
@@ -82,18 +84,26 @@ def main():
     logger.info("   加载 Compustat 数据...")
     try:
         cols_to_load = ['conm', 'gvkey', 'cusip', 'cik']
-        df_comp = pd.read_csv(
-            PATH_COMPUSTAT, 
-            usecols=cols_to_load, 
-            dtype=str,  # 保留前导零
-            low_memory=False
-        )
+        # PyArrow 多线程分块解析，只读取需要的列；全部按字符串读取以保留前导零
+        df_comp = pacsv.read_csv(
+            PATH_COMPUSTAT,
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=1 << 22),
+            parse_options=pacsv.ParseOptions(newlines_in_values=True),  # 带引号的单元格可能含换行
+            convert_options=pacsv.ConvertOptions(
+                include_columns=cols_to_load,
+                column_types={c: pa.string() for c in cols_to_load},
+                strings_can_be_null=True  # 空单元格读为缺失值（与 pandas 一致）
+            )
+        ).to_pandas()
         logger.info(f"   ✅ Compustat 数据加载完成: {len(df_comp):,} 行")
-    except ValueError:
+    except KeyError:
         # 如果列名不匹配，尝试全量读取
         logger.warning("   列名可能不匹配，尝试全量读取...")
         df_comp = pd.read_csv(PATH_COMPUSTAT, dtype=str, low_memory=False)
         logger.info(f"   ✅ Compustat 数据加载完成（全量）: {len(df_comp):,} 行")
+    except pa.ArrowInvalid as e:
+        logger.error(f"   ❌ Compustat CSV 解析失败: {e}")
+        return False
     except Exception as e:
         logger.error(f"   ❌ 读取失败: {e}")
         return False
@@ -102,7 +112,7 @@ def main():
     logger.info("\n步骤 2/4: 构建 Compustat 字典...")
     
     # 去除 conm 为空的行
-    df_comp_clean = df_comp[df_comp['conm'].notna()].copy()
+    df_comp_clean = df_comp[df_comp['conm'].notna()]
     
     # 按 conm 去重（保留第一条记录）
     df_comp_unique = df_comp_clean.drop_duplicates(subset=['conm'])
@@ -129,39 +139,27 @@ def main():
     # 3.2 与主表合并（填充现有的gvkey/cusip/cik列）
     logger.info("   阶段 3.2: 填充主表的ID列...")
     
-    # 创建映射字典
-    acquiror_to_ids = {}
-    for _, row in df_verify_with_ids.iterrows():
-        acquiror_name = row['Acquiror_Original']
-        acquiror_to_ids[acquiror_name] = {
-            'gvkey': row.get('gvkey', None),
-            'cusip': row.get('cusip', None),
-            'cik': row.get('cik', None),
-            'compustat_name': row.get('Matched_Compustat_Original', None)
-        }
+    # 以 Acquiror_Original 为索引的映射表（验证表已按该列去重）
+    df_id_map = df_verify_with_ids.set_index('Acquiror_Original')
+    id_sources = {
+        'gvkey': 'gvkey',
+        'cusip': 'cusip',
+        'cik': 'cik',
+        'compustat_name': 'Matched_Compustat_Original'
+    }
     
     # 填充现有列（保留原有值，仅填充空值）
-    df_final = df_main.copy()
-    
-    # 确保列存在
-    for col in ['gvkey', 'cusip', 'cik', 'compustat_name']:
-        if col not in df_final.columns:
-            df_final[col] = None
-    
-    # 逐行填充
-    for idx, row in df_final.iterrows():
-        acquiror_name = row['acquiror_name']
-        if acquiror_name in acquiror_to_ids:
-            ids = acquiror_to_ids[acquiror_name]
-            # 只填充空值
-            if pd.isna(df_final.at[idx, 'gvkey']):
-                df_final.at[idx, 'gvkey'] = ids['gvkey']
-            if pd.isna(df_final.at[idx, 'cusip']):
-                df_final.at[idx, 'cusip'] = ids['cusip']
-            if pd.isna(df_final.at[idx, 'cik']):
-                df_final.at[idx, 'cik'] = ids['cik']
-            if pd.isna(df_final.at[idx, 'compustat_name']):
-                df_final.at[idx, 'compustat_name'] = ids['compustat_name']
+    # 之后只做整列赋值且主表不再单独使用，无需复制
+    df_final = df_main
+    
+    # 向量化填充：按列 map 后只填补空值
+    # 先转 object，避免全空的 float64 列无法写入带前导零的字符串 ID
+    for col, src in id_sources.items():
+        mapped = df_final['acquiror_name'].map(df_id_map[src])
+        if col in df_final.columns:
+            df_final[col] = df_final[col].astype(object).fillna(mapped)
+        else:
+            df_final[col] = mapped
     
     logger.info(f"   ✅ 填充完成，最终行数: {len(df_final):,}")
     
@@ -169,7 +167,9 @@ def main():
     logger.info("\n步骤 4/4: 保存结果...")
     
     try:
-        df_final.to_excel(PATH_OUTPUT, index=False)
+        write_excel(df_final, PATH_OUTPUT)
+        # 同步写 .feather 缓存，下一轮步骤1/3 读取主表时直接命中
+        write_feather_cache(df_final, PATH_OUTPUT)
         logger.info(f"   ✅ 文件已保存: {PATH_OUTPUT}")
     except Exception as e:
         logger.error(f"   ❌ 保存失败: {e}")